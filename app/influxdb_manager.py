@@ -1,7 +1,9 @@
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS, WriteOptions
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
 import logging
 
+log = logging.getLogger("INFLUXDB")
+
 class InfluxDBClientManager:
     """Manages InfluxDB client connection and operations."""
 
@@ -12,39 +14,57 @@ class InfluxDBClientManager:
         self.org = org
         self.bucket = bucket
 
-        self.client = InfluxDBClient(url=self.url, token=self.token, org=self.org)
-        self.write_api = self.client.write_api(write_options=WriteOptions(write_type=SYNCHRONOUS))
+        # gzip compresses line protocol well since tag and field names repeat on every line
+        self.client = InfluxDBClient(
+            url=self.url,
+            token=self.token,
+            org=self.org,
+            enable_gzip=True,
+            connection_pool_maxsize=16
+        )
+
+        # Records are queued by write_data and sent together by flush as a single HTTP request.
+        # Synchronous writes aren't retried, so a failed flush returns within one cycle.
+        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        self._pending = []
 
     def bucket_exists(self):
         try:
             buckets_api = self.client.buckets_api()
-            buckets = buckets_api.find_buckets().buckets
-            
-            exists = any(bucket.name == self.bucket for bucket in buckets)
-            return exists
+            return buckets_api.find_bucket_by_name(self.bucket) is not None
         except Exception as e:
-            logging.error(f"INFLUXDB : Failed to check bucket: {e}")
+            log.error(f"Failed to check bucket: {e}")
             return False
 
     def create_bucket(self):
         try:
             buckets_api = self.client.buckets_api()
             buckets_api.create_bucket(bucket_name=self.bucket, org=self.org)
-            logging.info(f"INFLUXDB : Bucket '{self.bucket}' created.")
+            log.info(f"Bucket '{self.bucket}' created.")
             return True
         except Exception as e:
-            logging.error(f"INFLUXDB : Failed to create bucket: {e}")
+            log.error(f"Failed to create bucket: {e}")
             return False
 
     def write_data(self, point):
-        """Write data to InfluxDB."""
+        """Queue a line protocol record (second precision) for the next flush to InfluxDB."""
+        self._pending.append(point)
+
+    def flush(self):
+        """Send queued records to InfluxDB in one request. Returns True if they were written."""
+        if not self._pending:
+            return True
         try:
-            self.write_api.write(bucket=self.bucket, org=self.org, record=point)
+            self.write_api.write(bucket=self.bucket, org=self.org, record=self._pending, write_precision=WritePrecision.S)
             return True
         except Exception as e:
-            logging.error(f"INFLUXDB : Write failed: {e}")
+            log.error(f"Write failed: {e}")
             return False
+        finally:
+            # Failed records are dropped; the next cycle writes the observation again
+            self._pending = []
 
     def close(self):
         """Close connection."""
-        self.client.close()
\ No newline at end of file
+        self.write_api.close()
+        self.client.close()
@@ -1,73 +1,122 @@
 import os
+import sys
+import atexit
 import logging
+import math
 import time
-from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 import configparser
 import settings
 
-from influxdb_client import Point, WritePrecision
 from influxdb_manager import InfluxDBClientManager
-from wttr_manager import Wttr
+from wttr_manager import Wttr, UNCHANGED
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)8s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)8s - %(name)-8s : %(message)s')
+
+log = logging.getLogger("MAIN")
+influx_log = logging.getLogger("INFLUXDB")
+wttr_log = logging.getLogger("WTTR")
 
 def _load_config(file_path):
     """Load InfluxDB config from file."""
     config = configparser.ConfigParser()
     config.read(file_path)
-    logging.info(f"INFLUXDB : Configuration file '{file_path}' loaded.")
+    influx_log.info(f"Configuration file '{file_path}' loaded.")
     return config
 
-def wait_for_config(file_path, check_interval=5, max_wait=120):
+def wait_for_config(file_path, initial_interval=0.05, max_interval=2.0, max_wait=120):
     """Wait for InfluxDB container to provide config file."""
+    # Back off exponentially so a file that appears quickly is picked up quickly
     elapsed = 0
+    check_interval = initial_interval
     while not os.path.exists(file_path):
         if elapsed >= max_wait:
-            logging.error(f"INFLUXDB : Timeout waiting for config file")
+            influx_log.error("Timeout waiting for config file")
             raise TimeoutError(f"Configuration file '{file_path}' not found")
         time.sleep(check_interval)
         elapsed += check_interval
+        check_interval = min(check_interval * 2, max_interval)
 
-def _get_field_value(field_name, json_key, current_condition, nearest_area):
-    """Get field from API response with special cases for lat/long and Kelvin."""
-    if field_name in ["latitude", "longitude"]:
-        return nearest_area.get(json_key)
-    elif field_name == "temp_kelvin":
-        temp_c = current_condition.get("temp_C", 0)
-        try:
-            return float(temp_c) + settings.KELVIN_OFFSET
-        except (ValueError, TypeError) as e:
-            logging.error(f"WTTR     : Invalid temp_C for Kelvin: {temp_c} - {e}")
-            return None
-    else:
-        return current_condition.get(json_key)
+def wait_for_bucket(influx_manager, initial_interval=1.0, max_interval=30.0, max_wait=600):
+    """
+    Make sure the bucket exists, creating it if needed.
+    Retries with backoff while InfluxDB is unreachable; returns False if it never succeeds.
+    """
+    elapsed = 0
+    check_interval = initial_interval
+    while not (influx_manager.bucket_exists() or influx_manager.create_bucket()):
+        if elapsed >= max_wait:
+            influx_log.error(f"Bucket '{influx_manager.bucket}' unavailable after {elapsed:.0f}s")
+            return False
+        influx_log.warning(f"Bucket check failed, retrying in {check_interval:.0f}s")
+        time.sleep(check_interval)
+        elapsed += check_interval
+        check_interval = min(check_interval * 2, max_interval)
+    return True
+
+def _compile_measurements(measurements):
+    """
+    Split field mappings by where their values come from, once up front.
+    Returns (current_condition fields, nearest_area fields, whether Kelvin is wanted).
+    """
+    area_names = ("latitude", "longitude")
+    current_fields = tuple((name, key) for name, key in measurements.items()
+                           if name not in area_names and name != "temp_kelvin")
+    area_fields = tuple((name, key) for name, key in measurements.items() if name in area_names)
+    return current_fields, area_fields, "temp_kelvin" in measurements
+
+def _kelvin_value(current_condition):
+    """Derive Kelvin from temp_C (wttr.in has no Kelvin field)."""
+    temp_c = current_condition.get("temp_C", 0)
+    try:
+        return float(temp_c) + settings.KELVIN_OFFSET
+    except (ValueError, TypeError) as e:
+        wttr_log.error(f"Invalid temp_C for Kelvin: {temp_c} - {e}")
+        return None
+
+# Field mappings from settings, split once at import
+_MEASUREMENT_FIELDS = _compile_measurements(settings.MEASUREMENTS)
+
+# Observation times are naive UTC datetimes; epoch offsets are computed by subtraction
+_EPOCH = datetime(1970, 1, 1)
+_ONE_SECOND = timedelta(seconds=1)
+
+# Per-cycle buffers, cleared and refilled each cycle instead of reallocated
+_POINTS_BUF = []
+_RECORDED_BUF = []
 
 def _write_point(influx_manager, point, city, timestamp, missing_fields, last_seen):
     """ 
-    Write weather report to InfluxDB. 
+    Queue a weather report for the cycle's InfluxDB write (sent by influx_manager.flush()).
     Returns city name if new timestamp recorded, None otherwise.
+
+    No existence query is made: re-writing the same city and timestamp
+    overwrites the stored point, so last_seen is only used for logging.
     """
-    # Check if this is a new timestamp for this city
-    is_new = last_seen.get(city) != timestamp
-
-    if influx_manager.write_data(point):
-        if is_new:
-            last_seen[city] = timestamp
-            if missing_fields:
-                logging.warning(f"INFLUXDB : Missing fields for {city}: {', '.join(missing_fields)}")
-            return city  # Return city name for summary collection
-        else:
-            logging.debug(f"INFLUXDB : Re-wrote {city} ({timestamp}) - same timestamp.")
+    influx_manager.write_data(point)
 
-        if missing_fields:
-            logging.warning(f"INFLUXDB : Missing fields for {city}: {', '.join(missing_fields)}")
-        return None
+    if missing_fields:
+        influx_log.warning(f"Missing fields for {city}: {', '.join(missing_fields)}")
+
+    # Check if this is a new timestamp for this city
+    if last_seen.get(city) != timestamp:
+        last_seen[city] = timestamp
+        return city  # Return city name for summary collection
 
+    influx_log.debug("Re-wrote %s (%s) - same timestamp.", city, timestamp)
     return None
     
-def _build_point(data, city_info, measurements, wttr):
-    """Transform weather report for InfluxDB."""
+@lru_cache(maxsize=None)
+def _line_prefix(city, country):
+    """Measurement and escaped tag set for a city's line protocol records."""
+    def escape(value):
+        return value.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+    return f"weather_data,city={escape(city)},country={escape(country)}"
+
+def _build_point(data, city_info, fields, wttr):
+    """Transform weather report into an InfluxDB line protocol record."""
     city = city_info["city"]
     country = city_info["country"]
     current_condition = data.get("current_condition", [{}])[0]
@@ -78,30 +127,43 @@ def _build_point(data, city_info, measurements, wttr):
     if timestamp_dt is None:
         return (None, [], city, None)
 
-    # Convert to ISO string for InfluxDB (used for both write and query)
-    timestamp_str = timestamp_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    # ISO string identifies the observation for duplicate tracking and logs
+    timestamp_str = timestamp_dt.isoformat(timespec='seconds') + 'Z'
+    # Observations have minute resolution, so records are written with second precision
+    timestamp_s = (timestamp_dt - _EPOCH) // _ONE_SECOND
 
-    point = Point("weather_data") \
-        .tag("city", city) \
-        .tag("country", country) \
-        .time(timestamp_str, WritePrecision.NS)
+    current_fields, area_fields, has_kelvin = fields
+    values = [(field_name, current_condition.get(json_key)) for field_name, json_key in current_fields]
+    values += [(field_name, nearest_area.get(json_key)) for field_name, json_key in area_fields]
+    if has_kelvin:
+        values.append(("temp_kelvin", _kelvin_value(current_condition)))
 
     missing_fields = []
+    field_set = []
 
-    for field_name, json_key in measurements.items():
-        value = _get_field_value(field_name, json_key, current_condition, nearest_area)
-
+    for field_name, value in values:
         if value is not None:
             try:
                 value = float(value)
-                point.field(field_name, value)
             except (ValueError, TypeError) as e:
-                logging.error(f"WTTR     : Invalid numeric value for '{field_name}' in {city}: {value} - {e}")
+                wttr_log.error(f"Invalid numeric value for '{field_name}' in {city}: {value} - {e}")
+                missing_fields.append(field_name)
+                continue
+            # NaN and infinity aren't valid line protocol and would fail the whole cycle's write
+            if math.isfinite(value):
+                field_set.append(f"{field_name}={value}")
+            else:
+                wttr_log.error(f"Non-finite value for '{field_name}' in {city}: {value}")
                 missing_fields.append(field_name)
         else:
-            logging.warning(f"WTTR     : Measurement '{field_name}' not found for {city}.")
+            wttr_log.warning(f"Measurement '{field_name}' not found for {city}.")
             missing_fields.append(field_name)
 
+    # A record needs at least one field to be valid line protocol
+    if not field_set:
+        return (None, missing_fields, city, timestamp_str)
+
+    point = f"{_line_prefix(city, country)} {','.join(field_set)} {timestamp_s}"
     return (point, missing_fields, city, timestamp_str)
 
 def _fetch_and_process_weather_data(wttr, influx_manager, last_seen_timestamps):
@@ -109,84 +171,129 @@ def _fetch_and_process_weather_data(wttr, influx_manager, last_seen_timestamps):
     Fetch weather reports and write to InfluxDB. 
     Returns timing metrics, successful city count, and recorded cities.
     """
-    # Fetch phase
-    fetch_start = time.time()
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        results = list(executor.map(wttr.fetch_data, settings.CITY_DICTS))
-    fetch_duration = time.time() - fetch_start
-
-    # Transform phase
-    transform_start = time.time()
-    points_to_write = []
-    for city_info, data in zip(settings.CITY_DICTS, results):
-        if data:
-            point, missing_fields, city, timestamp = _build_point(data, city_info, settings.MEASUREMENTS, wttr)
+    # Fetch and transform phases overlap: each report is transformed as soon as it arrives
+    fetch_start = time.monotonic()
+    transform_duration = 0.0
+    points_to_write = _POINTS_BUF
+    points_to_write.clear()
+    unchanged_cities = 0
+    for city_info, data in wttr.fetch_many(settings.CITY_DICTS):
+        if data is UNCHANGED:
+            # Same observation as last time; nothing new to write
+            unchanged_cities += 1
+        elif data:
+            transform_start = time.monotonic()
+            point, missing_fields, city, timestamp = _build_point(data, city_info, _MEASUREMENT_FIELDS, wttr)
             if point is not None:
-                points_to_write.append((point, city, timestamp, missing_fields))
-    transform_duration = time.time() - transform_start
-
-    # Record phase
-    record_start = time.time()
-    recorded_cities = []
-    for point, city, timestamp, missing_fields in points_to_write:
-        recorded_city = _write_point(influx_manager, point, city, timestamp, missing_fields, last_seen_timestamps)
+                points_to_write.append((point, city, timestamp, missing_fields, city_info, data))
+            transform_duration += time.monotonic() - transform_start
+    fetch_duration = time.monotonic() - fetch_start - transform_duration
+
+    # Record phase: timestamps are staged and only kept once the flush succeeds
+    record_start = time.monotonic()
+    recorded_cities = _RECORDED_BUF
+    recorded_cities.clear()
+    staged_timestamps = dict(last_seen_timestamps)
+    for point, city, timestamp, missing_fields, _, _ in points_to_write:
+        recorded_city = _write_point(influx_manager, point, city, timestamp, missing_fields, staged_timestamps)
         if recorded_city:
             recorded_cities.append(recorded_city)
-    record_duration = time.time() - record_start
-
-    return fetch_duration, transform_duration, record_duration, len(points_to_write), recorded_cities
-
-def _collect_weather_data(config, last_seen_timestamps):
-    """Set up managers and run weather report collection cycle."""
-    start_time = time.time()
-
-    influx_manager = InfluxDBClientManager(
-        url=settings.INFLUXDB_URL,
-        token=config['default']['token'].strip('"\''),
-        org=config['default']['org'].strip('"\''),
-        bucket=settings.BUCKET_NAME
-    )
+    if influx_manager.flush():
+        last_seen_timestamps.update(staged_timestamps)
+        for _, _, _, _, city_info, data in points_to_write:
+            wttr.mark_written(city_info, data)
+    else:
+        recorded_cities.clear()
+    record_duration = time.monotonic() - record_start
 
-    if not influx_manager.bucket_exists():
-        if not influx_manager.create_bucket():
-            return
+    successful_cities = len(points_to_write) + unchanged_cities
+    return fetch_duration, transform_duration, record_duration, successful_cities, recorded_cities
 
-    wttr = Wttr(settings.WTTR_URL_TEMPLATE)
+def _collect_weather_data(influx_manager, wttr, last_seen_timestamps):
+    """Run weather report collection cycle."""
+    start_time = time.monotonic()
 
     fetch_duration, transform_duration, record_duration, successful_cities, recorded_cities = _fetch_and_process_weather_data(
         wttr, influx_manager, last_seen_timestamps
     )
 
-    influx_manager.close()
-
     # Build summary line
-    total_duration = time.time() - start_time
-    budget_pct = (total_duration / 30.0) * 100
+    total_duration = time.monotonic() - start_time
+    budget_pct = (total_duration / settings.POLL_INTERVAL) * 100
 
     # Format with fixed-width fields for alignment: 
     # Cities: 10/10 | Fetch: 340.8ms | Transform:  0.5ms | Record: 23.6ms | Total:  378.7ms (1.3%) | Recorded: [cities]
-    summary = f"         : Cities: {successful_cities:2d}/{len(settings.CITY_DICTS)} | "
-    summary += f"Fetch: {fetch_duration * 1000:8.1f}ms | "
-    summary += f"Transform: {transform_duration * 1000:6.1f}ms | "
-    summary += f"Record: {record_duration * 1000:6.1f}ms | "
-    summary += f"Total: {total_duration * 1000:8.1f}ms ({budget_pct:4.1f}%)"
+    summary = [
+        f"Cities: {successful_cities:2d}/{len(settings.CITY_DICTS)} | ",
+        f"Fetch: {fetch_duration * 1000:8.1f}ms | ",
+        f"Transform: {transform_duration * 1000:6.1f}ms | ",
+        f"Record: {record_duration * 1000:6.1f}ms | ",
+        f"Total: {total_duration * 1000:8.1f}ms ({budget_pct:4.1f}%)",
+    ]
 
     # Add recorded cities if any
     if recorded_cities:
-        summary += f" | Recorded: {', '.join(recorded_cities)}"
+        summary.append(f" | Recorded: {', '.join(recorded_cities)}")
 
-    logging.info(summary)
+    log.info("".join(summary))
+
+def _get_credentials():
+    """Get InfluxDB token and org from environment, falling back to config file."""
+    token = os.environ.get(settings.INFLUXDB_TOKEN_ENV)
+    org = os.environ.get(settings.INFLUXDB_ORG_ENV)
+    if token and org:
+        influx_log.info("Credentials loaded from environment.")
+        return token, org
 
-def main():
     config_path = settings.INFLUXDB_CONFIG
     wait_for_config(config_path)
     config = _load_config(config_path)
+    return config['default']['token'].strip('"\''), config['default']['org'].strip('"\'')
+
+def main():
+    token, org = _get_credentials()
+
+    # Managers live for the whole run so connections are reused between cycles
+    influx_manager = InfluxDBClientManager(
+        url=settings.INFLUXDB_URL,
+        token=token,
+        org=org,
+        bucket=settings.BUCKET_NAME
+    )
+    atexit.register(influx_manager.close)
+
+    if not wait_for_bucket(influx_manager):
+        sys.exit(1)
+
+    wttr = Wttr(
+        settings.WTTR_URL_TEMPLATE,
+        timeout=settings.WTTR_TIMEOUT,
+        max_workers=max(1, min(settings.WTTR_MAX_WORKERS, len(settings.CITY_DICTS))),
+        cache_ttl=settings.WTTR_CACHE_TTL,
+        skip_unchanged=settings.WTTR_SKIP_UNCHANGED
+    )
+    atexit.register(wttr.close)
+    Wttr.warm_timezones(settings.CITY_DICTS)
+
+    # City names key last_seen and the wttr/line-prefix caches on every poll;
+    # interning them once lets those lookups match by identity
+    for city_info in settings.CITY_DICTS:
+        city_info["city"] = sys.intern(city_info["city"])
 
     last_seen_timestamps = {}  # Track last timestamp per city for logging
 
+    # Schedule cycles on fixed deadlines so collection time doesn't accumulate as drift
+    next_deadline = time.monotonic()
     while True:
-        _collect_weather_data(config, last_seen_timestamps)
-        time.sleep(30)
+        _collect_weather_data(influx_manager, wttr, last_seen_timestamps)
+        next_deadline += settings.POLL_INTERVAL
+        sleep_time = next_deadline - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        else:
+            if -sleep_time > 1:
+                log.warning(f"Cycle overran schedule by {-sleep_time:.1f}s")
+            next_deadline = time.monotonic()
 
 if __name__ == "__main__":
     main()
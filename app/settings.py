@@ -1,6 +1,7 @@
 # Cities to monitor for weather data
 # Note: Using 3-letter ISO country codes (USA, MEX, CRI)
 # Timezone: IANA timezone identifier for converting localObsDateTime to UTC
+# Optional "timeout": (connect, read) seconds overriding WTTR_TIMEOUT for a slow city
 #
 # LIMITATION: Timezones are statically configured per city.
 # Use geonames API (http://api.geonames.org/timezoneJSON)
@@ -33,11 +34,30 @@ MEASUREMENTS = {
 # Kelvin equivalent of zero degrees Celsius (zero sig figs)
 KELVIN_OFFSET = 273
 
+# Seconds between the start of each collection cycle
+POLL_INTERVAL = 30
+
 # wttr.in API configuration
 # j2 format excludes hourly forecasts (92% reduction in payload size: 50KB -> 4KB)
 WTTR_URL_TEMPLATE = "http://wttr.in/{city},{country}?format=j2"
+# (connect, read) timeouts in seconds; bounds how long one slow city can stall a cycle
+WTTR_TIMEOUT = (3.05, 5)
+# Most concurrent wttr.in requests per cycle; wttr.in is rate limited, so larger
+# city lists are fetched in waves rather than all at once
+WTTR_MAX_WORKERS = 16
+# Seconds to reuse a city's last successful report before fetching again (0 disables).
+# wttr.in refreshes observations every ~15 minutes, so most polls would return the
+# same data; a new observation is picked up at most this long after it appears.
+WTTR_CACHE_TTL = 600
+# Skip building and writing a point when a city's observation time hasn't changed
+# since the last report; the repeat would only overwrite the same point in InfluxDB
+WTTR_SKIP_UNCHANGED = True
 
 # InfluxDB configuration
+# Credentials are read from these environment variables when both are set;
+# otherwise the app waits for the config file written by the influxdb2 container
+INFLUXDB_TOKEN_ENV = "INFLUXDB_TOKEN"
+INFLUXDB_ORG_ENV = "INFLUXDB_ORG"
 INFLUXDB_CONFIG = "/usr/src/influxdb2_config/influx-configs"
 INFLUXDB_URL = "http://influxdb2:8086"
 BUCKET_NAME = "weather_data"
\ No newline at end of file
@@ -1,14 +1,19 @@
+import json
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock, patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, PropertyMock, patch
 from datetime import datetime
 
-from main import _build_point, _write_point
 from influxdb_manager import InfluxDBClientManager
 from wttr_manager import Wttr
 
 class TestWeatherDataProcessing(unittest.TestCase):
 
     def test_build_point(self):
+        from main import _build_point, _compile_measurements
+
         data = {
             "current_condition": [{
                 "localObsDateTime": "2025-04-21 11:55 AM",
@@ -33,14 +38,63 @@ class TestWeatherDataProcessing(unittest.TestCase):
         mock_wttr = MagicMock()
         mock_wttr.parse_observation_time.return_value = datetime(2025, 4, 21, 11, 55)
 
-        point, missing_fields, city, timestamp = _build_point(data, city_info, measurements, mock_wttr)
+        point, missing_fields, city, timestamp = _build_point(data, city_info, _compile_measurements(measurements), mock_wttr)
 
-        self.assertIsNotNone(point)
+        self.assertEqual(
+            point,
+            "weather_data,city=TestCity,country=TestCountry "
+            "temp_celsius=20.0,humidity=74.0,pressure=30.0,temp_kelvin=293.0 "
+            "1745236500"
+        )
         self.assertEqual(city, "TestCity")
         self.assertEqual(timestamp, "2025-04-21T11:55:00Z")
         self.assertEqual(len(missing_fields), 0)
 
+    def test_build_point_escapes_tags(self):
+        """Test that spaces in city names are escaped in line protocol tags."""
+        from main import _build_point, _compile_measurements
+
+        data = {
+            "current_condition": [{"temp_C": "20"}],
+            "nearest_area": [{}]
+        }
+        city_info = {"city": "Los Angeles", "country": "USA", "tz": "America/Los_Angeles"}
+
+        mock_wttr = MagicMock()
+        mock_wttr.parse_observation_time.return_value = datetime(2025, 4, 21, 11, 55)
+
+        point, _, _, _ = _build_point(data, city_info, _compile_measurements({"temp_celsius": "temp_C"}), mock_wttr)
+
+        self.assertTrue(point.startswith("weather_data,city=Los\\ Angeles,country=USA "))
+
+    def test_build_point_non_finite_values(self):
+        """Test that NaN and infinity are reported as missing instead of written."""
+        from main import _build_point, _compile_measurements
+
+        data = {
+            "current_condition": [{"temp_C": "NaN", "humidity": "inf", "pressureInches": "30"}],
+            "nearest_area": [{}]
+        }
+        city_info = {"city": "TestCity", "country": "TestCountry", "tz": "UTC"}
+        measurements = {
+            "temp_celsius": "temp_C",
+            "temp_kelvin": "temp_K",
+            "humidity": "humidity",
+            "pressure": "pressureInches"
+        }
+
+        mock_wttr = MagicMock()
+        mock_wttr.parse_observation_time.return_value = datetime(2025, 4, 21, 11, 55)
+
+        with self.assertLogs(level='ERROR'):
+            point, missing_fields, _, _ = _build_point(data, city_info, _compile_measurements(measurements), mock_wttr)
+
+        self.assertEqual(point, "weather_data,city=TestCity,country=TestCountry pressure=30.0 1745236500")
+        self.assertEqual(sorted(missing_fields), ["humidity", "temp_celsius", "temp_kelvin"])
+
     def test_build_point_invalid_timestamp(self):
+        from main import _build_point, _compile_measurements
+
         data = {
             "current_condition": [{
                 "localObsDateTime": "INVALID",
@@ -55,20 +109,36 @@ class TestWeatherDataProcessing(unittest.TestCase):
         mock_wttr = MagicMock()
         mock_wttr.parse_observation_time.return_value = None
 
-        point, missing_fields, city, timestamp = _build_point(data, city_info, measurements, mock_wttr)
+        point, missing_fields, city, timestamp = _build_point(data, city_info, _compile_measurements(measurements), mock_wttr)
 
         self.assertIsNone(point)
         self.assertEqual(city, "TestCity")
         self.assertIsNone(timestamp)
         self.assertEqual(len(missing_fields), 0)
 
+    def test_compile_measurements(self):
+        """Test that field mappings are split by source with Kelvin handled separately."""
+        from main import _compile_measurements
+
+        measurements = {
+            "temp_celsius": "temp_C",
+            "temp_kelvin": "temp_K",
+            "latitude": "latitude",
+        }
+
+        current_fields, area_fields, has_kelvin = _compile_measurements(measurements)
+
+        self.assertEqual(current_fields, (("temp_celsius", "temp_C"),))
+        self.assertEqual(area_fields, (("latitude", "latitude"),))
+        self.assertTrue(has_kelvin)
+
     @patch('influxdb_manager.InfluxDBClientManager')
     def test_write_point_success(self, MockInfluxDBClientManager):
+        from main import _write_point
+
         mock_manager = MockInfluxDBClientManager()
-        mock_manager.write_data.return_value = True
 
-        from influxdb_client import Point
-        point = Point("weather_data").tag("city", "TestCity").field("temp", 20.0)
+        point = "weather_data,city=TestCity temp=20.0"
 
         last_seen = {}
         result = _write_point(mock_manager, point, "TestCity", "2025-04-21T11:55:00Z", [], last_seen)
@@ -80,11 +150,11 @@ class TestWeatherDataProcessing(unittest.TestCase):
     @patch('influxdb_manager.InfluxDBClientManager')
     def test_write_point_new_timestamp(self, MockInfluxDBClientManager):
         """Test that new timestamps return city name and update last_seen."""
+        from main import _write_point
+
         mock_manager = MockInfluxDBClientManager()
-        mock_manager.write_data.return_value = True
 
-        from influxdb_client import Point
-        point = Point("weather_data").tag("city", "TestCity").field("temp", 20.0)
+        point = "weather_data,city=TestCity temp=20.0"
 
         last_seen = {}
         result = _write_point(mock_manager, point, "TestCity", "2025-04-21T11:55:00Z", [], last_seen)
@@ -95,11 +165,11 @@ class TestWeatherDataProcessing(unittest.TestCase):
     @patch('influxdb_manager.InfluxDBClientManager')
     def test_write_point_duplicate_timestamp(self, MockInfluxDBClientManager):
         """Test that duplicate timestamps return None and log at DEBUG level."""
+        from main import _write_point
+
         mock_manager = MockInfluxDBClientManager()
-        mock_manager.write_data.return_value = True
 
-        from influxdb_client import Point
-        point = Point("weather_data").tag("city", "TestCity").field("temp", 20.0)
+        point = "weather_data,city=TestCity temp=20.0"
 
         # Simulate timestamp already seen
         last_seen = {"TestCity": "2025-04-21T11:55:00Z"}
@@ -114,6 +184,88 @@ class TestWeatherDataProcessing(unittest.TestCase):
         # Timestamp should remain unchanged
         self.assertEqual(last_seen["TestCity"], "2025-04-21T11:55:00Z")
 
+    @patch('main.time.sleep')
+    @patch('main.os.path.exists', return_value=False)
+    def test_wait_for_config_backs_off(self, mock_exists, mock_sleep):
+        """Test that config polling starts fast, doubles up to a cap, and times out."""
+        from main import wait_for_config
+
+        with self.assertLogs(level='ERROR'):
+            with self.assertRaises(TimeoutError):
+                wait_for_config("/missing", initial_interval=0.5, max_interval=2.0, max_wait=6)
+
+        delays = [c.args[0] for c in mock_sleep.call_args_list]
+        self.assertEqual(delays, [0.5, 1.0, 2.0, 2.0, 2.0])
+
+    @patch('main.time.sleep')
+    def test_wait_for_bucket_retries(self, mock_sleep):
+        """Test that the bucket check is retried with backoff until it succeeds or times out."""
+        from main import wait_for_bucket
+
+        mock_manager = MagicMock()
+        mock_manager.bucket_exists.side_effect = [False, False, True]
+        mock_manager.create_bucket.return_value = False
+
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(wait_for_bucket(mock_manager, initial_interval=1, max_interval=30, max_wait=600))
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1, 2])
+
+        mock_manager.bucket_exists.side_effect = None
+        mock_manager.bucket_exists.return_value = False
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(wait_for_bucket(mock_manager, initial_interval=1, max_interval=2, max_wait=5))
+
+    @patch('influxdb_manager.InfluxDBClient')
+    def test_flush_sends_queued_records_once(self, MockInfluxDBClient):
+        """Test that flush sends all queued records in one write and reports failures."""
+        manager = InfluxDBClientManager("http://localhost:8086", "token", "org", "bucket")
+        write = manager.write_api.write
+
+        manager.write_data("weather_data,city=A temp=1.0 1")
+        manager.write_data("weather_data,city=B temp=2.0 1")
+        self.assertTrue(manager.flush())
+
+        write.assert_called_once()
+        self.assertEqual(write.call_args.kwargs["record"], ["weather_data,city=A temp=1.0 1", "weather_data,city=B temp=2.0 1"])
+
+        # Nothing queued means nothing to send
+        self.assertTrue(manager.flush())
+        write.assert_called_once()
+
+        write.side_effect = Exception("connection refused")
+        manager.write_data("weather_data,city=A temp=1.0 2")
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(manager.flush())
+        self.assertEqual(manager._pending, [])
+
+    @patch('main.settings.CITY_DICTS', [{"city": "TestCity", "country": "TestCountry", "tz": "UTC"}])
+    def test_failed_flush_records_nothing(self):
+        """Test that cities are only tracked as recorded once their write succeeds."""
+        from main import _fetch_and_process_weather_data
+
+        city_info = {"city": "TestCity", "country": "TestCountry", "tz": "UTC"}
+        data = {
+            "current_condition": [{"localObsDateTime": "2025-04-21 11:55 AM", "temp_C": "20"}],
+            "nearest_area": [{}]
+        }
+        mock_wttr = MagicMock()
+        mock_wttr.fetch_many.return_value = [(city_info, data)]
+        mock_wttr.parse_observation_time.return_value = datetime(2025, 4, 21, 11, 55)
+        mock_manager = MagicMock()
+        last_seen = {}
+
+        mock_manager.flush.return_value = False
+        result = _fetch_and_process_weather_data(mock_wttr, mock_manager, last_seen)
+        self.assertEqual(result[4], [])
+        self.assertEqual(last_seen, {})
+        mock_wttr.mark_written.assert_not_called()
+
+        mock_manager.flush.return_value = True
+        result = _fetch_and_process_weather_data(mock_wttr, mock_manager, last_seen)
+        self.assertEqual(result[4], ["TestCity"])
+        self.assertEqual(last_seen, {"TestCity": "2025-04-21T11:55:00Z"})
+        mock_wttr.mark_written.assert_called_once_with(city_info, data)
+
     def test_timezone_conversion(self):
         """Test that timezone conversion from local to UTC works correctly."""
         # Simulate LA observation at 8:28 AM PDT (should become 15:28 UTC)
@@ -124,8 +276,7 @@ class TestWeatherDataProcessing(unittest.TestCase):
         }
         city_info = {"city": "Los Angeles", "country": "USA", "tz": "America/Los_Angeles"}
 
-        wttr = Wttr("http://wttr.in/{city},{country}?format=j2")
-        result = wttr.parse_observation_time(data, city_info)
+        result = Wttr.parse_observation_time(data, city_info)
 
         self.assertIsNotNone(result)
         # Verify it's a datetime object
@@ -137,19 +288,246 @@ class TestWeatherDataProcessing(unittest.TestCase):
         self.assertEqual(result.hour, 15)
         self.assertEqual(result.minute, 28)
 
-    @patch('requests.get')
+    def test_warm_timezones_skips_unknown_zone(self):
+        """Test that an unknown timezone is logged without stopping the others loading."""
+        from wttr_manager import _get_zone
+
+        cities = [
+            {"city": "Nowhere", "country": "XX", "tz": "Not/AZone"},
+            {"city": "Los Angeles", "country": "USA", "tz": "America/Los_Angeles"},
+        ]
+        with self.assertLogs(level='ERROR') as log:
+            Wttr.warm_timezones(cities)
+
+        self.assertIn("Unknown timezone for Nowhere", ''.join(log.output))
+        self.assertIsNotNone(_get_zone("America/Los_Angeles"))
+
+    def test_parse_observation_time_dst_change_day(self):
+        """Test that times on a DST change day get the offset in effect at that time."""
+        city_info = {"city": "Los Angeles", "country": "USA", "tz": "America/Los_Angeles"}
+
+        def parse(local_obs_str):
+            data = {"current_condition": [{"localObsDateTime": local_obs_str}]}
+            return Wttr.parse_observation_time(data, city_info)
+
+        # Clocks went forward at 2:00 AM PST on 2025-03-09
+        self.assertEqual(parse("2025-03-09 01:30 AM"), datetime(2025, 3, 9, 9, 30))
+        self.assertEqual(parse("2025-03-09 03:30 AM"), datetime(2025, 3, 9, 10, 30))
+        self.assertEqual(parse("2025-03-10 03:30 AM"), datetime(2025, 3, 10, 10, 30))
+
+    def test_parse_observation_time_12_hour_clock(self):
+        """Test that 12 AM/PM map to midnight/noon and bad formats return None."""
+        city_info = {"city": "TestCity", "country": "TestCountry", "tz": "UTC"}
+
+        def parse(local_obs_str):
+            data = {"current_condition": [{"localObsDateTime": local_obs_str}]}
+            return Wttr.parse_observation_time(data, city_info)
+
+        self.assertEqual(parse("2025-04-21 12:05 AM"), datetime(2025, 4, 21, 0, 5))
+        self.assertEqual(parse("2025-04-21 12:05 PM"), datetime(2025, 4, 21, 12, 5))
+        self.assertEqual(parse("2025-04-21 01:05 PM"), datetime(2025, 4, 21, 13, 5))
+        self.assertEqual(parse("2025-04-21 1:05 PM"), datetime(2025, 4, 21, 13, 5))
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(parse("INVALID"))
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(parse("2025-04-21 01:05 XM"))
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(parse("2025-04-21 13:05 PM"))
+
+    @patch('requests.Session.get')
     def test_wttr_fetch_data(self, mock_get):
         mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {
+        mock_get.return_value.content = json.dumps({
             "current_condition": [{"temp_C": "20"}],
-            "nearest_area": [{"areaName": [{"value": "TestCity"}]}]
-        }
+            "nearest_area": [{"areaName": [{"value": "TestCity"}]}],
+            "weather": [{"maxtempC": "25"}]
+        }).encode()
         wttr = Wttr("http://wttr.in/{city},{country}?format=j1")
         city_info = {"city": "TestCity", "country": "TestCountry"}
         data = wttr.fetch_data(city_info)
 
         self.assertIsNotNone(data)
+        self.assertEqual(set(data), {"current_condition", "nearest_area"})
+        mock_get.assert_called_once()
+        self.assertEqual(mock_get.call_args.args[0], "http://wttr.in/TestCity,TestCountry?format=j1")
+
+    @patch('requests.Session.get')
+    def test_wttr_url_template_fallback(self, mock_get):
+        """Test that templates the fast path can't split still build the right URL."""
+        mock_get.return_value.status_code = 500
+        wttr = Wttr("http://wttr.in/{country}/{city}?format=j2")
+        city_info = {"city": "Los Angeles", "country": "USA"}
+
+        with self.assertLogs(level='ERROR'):
+            wttr.fetch_data(city_info)
+
+        self.assertEqual(mock_get.call_args.args[0], "http://wttr.in/USA/Los+Angeles?format=j2")
+
+    @patch('requests.Session.get')
+    def test_wttr_fetch_data_cache(self, mock_get):
+        """Test that successful reports are reused within the TTL and failures are not cached."""
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.content = json.dumps({
+            "current_condition": [{"temp_C": "20"}],
+            "nearest_area": [{"areaName": [{"value": "TestCity"}]}]
+        }).encode()
+        wttr = Wttr("http://wttr.in/{city},{country}?format=j2", cache_ttl=600)
+        city_info = {"city": "TestCity", "country": "TestCountry"}
+
+        first = wttr.fetch_data(city_info)
+        second = wttr.fetch_data(city_info)
+
+        self.assertIs(first, second)
         mock_get.assert_called_once()
 
+        # Failed fetches are never cached
+        mock_get.return_value.status_code = 500
+        other_city = {"city": "OtherCity", "country": "TestCountry"}
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(wttr.fetch_data(other_city))
+            self.assertIsNone(wttr.fetch_data(other_city))
+        self.assertEqual(mock_get.call_count, 3)
+
+    @patch('requests.Session.get')
+    def test_wttr_fetch_data_skip_unchanged(self, mock_get):
+        """Test that a written observation time returns UNCHANGED when fetched again."""
+        from wttr_manager import UNCHANGED
+        report = {
+            "current_condition": [{"temp_C": "20", "localObsDateTime": "2025-04-21 01:55 PM"}],
+            "nearest_area": [{"areaName": [{"value": "TestCity"}]}]
+        }
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.content = json.dumps(report).encode()
+        wttr = Wttr("http://wttr.in/{city},{country}?format=j2", skip_unchanged=True)
+        city_info = {"city": "TestCity", "country": "TestCountry"}
+
+        # Not UNCHANGED until the observation has been written
+        self.assertEqual(wttr.fetch_data(city_info), report)
+        self.assertEqual(wttr.fetch_data(city_info), report)
+        wttr.mark_written(city_info, report)
+        self.assertIs(wttr.fetch_data(city_info), UNCHANGED)
+
+        # A new observation is returned again
+        report["current_condition"][0]["localObsDateTime"] = "2025-04-21 02:10 PM"
+        mock_get.return_value.content = json.dumps(report).encode()
+        self.assertEqual(wttr.fetch_data(city_info), report)
+
+    @patch('requests.Session.get')
+    def test_wttr_fetch_data_404_wrong_city(self, mock_get):
+        """Test that a 404 carrying another city's report is logged as a warning."""
+        mock_get.return_value.status_code = 404
+        mock_get.return_value.headers = {}
+        mock_get.return_value.content = json.dumps({
+            "current_condition": [{"temp_C": "20"}],
+            "nearest_area": [{"areaName": [{"value": "OtherCity"}]}],
+            "padding": "x" * 1000
+        }).encode()
+        wttr = Wttr("http://wttr.in/{city},{country}?format=j2")
+        city_info = {"city": "TestCity", "country": "TestCountry"}
+
+        with self.assertLogs(level='WARNING') as log:
+            data = wttr.fetch_data(city_info)
+
+        self.assertIsNone(data)
+        self.assertIn("API returned 'OtherCity'", ''.join(log.output))
+
+    @patch('requests.Session.get')
+    def test_wttr_fetch_data_404_short_body(self, mock_get):
+        """Test that a short 404 is judged by Content-Length without parsing the body."""
+        mock_get.return_value.status_code = 404
+        mock_get.return_value.headers = {"Content-Length": "20"}
+        type(mock_get.return_value).content = PropertyMock(side_effect=AssertionError("body was read"))
+        wttr = Wttr("http://wttr.in/{city},{country}?format=j2")
+        city_info = {"city": "TestCity", "country": "TestCountry"}
+
+        with self.assertLogs(level='ERROR') as log:
+            data = wttr.fetch_data(city_info)
+
+        self.assertIsNone(data)
+        self.assertIn("Failed [HTTP 404] TestCity", ''.join(log.output))
+
+    @patch('requests.Session.get')
+    def test_wttr_fetch_data_404_bad_content_length(self, mock_get):
+        """Test that a malformed Content-Length falls back to the body size."""
+        mock_get.return_value.status_code = 404
+        mock_get.return_value.headers = {"Content-Length": "abc"}
+        mock_get.return_value.content = b"Not found"
+        wttr = Wttr("http://wttr.in/{city},{country}?format=j2")
+        city_info = {"city": "TestCity", "country": "TestCountry"}
+
+        with self.assertLogs(level='ERROR') as log:
+            data = wttr.fetch_data(city_info)
+
+        self.assertIsNone(data)
+        self.assertIn("Failed [HTTP 404] TestCity", ''.join(log.output))
+
+    def _serve(self, handler_class):
+        """Run a local HTTP server for the test and return its base URL."""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    @patch('urllib3.util.retry.time.sleep')
+    def test_wttr_retries_gateway_errors_without_retry_after(self, mock_sleep):
+        """Test that 503s are retried twice with short backoff, ignoring Retry-After."""
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.path)
+                self.send_response(503)
+                self.send_header("Retry-After", "21600")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        wttr = Wttr(self._serve(Handler) + "/{city},{country}", timeout=(1, 1))
+        self.addCleanup(wttr.close)
+
+        with self.assertLogs(level='ERROR') as log:
+            self.assertIsNone(wttr.fetch_data({"city": "TestCity", "country": "TestCountry"}))
+
+        self.assertEqual(len(requests_seen), 3)
+        self.assertTrue(all(c.args[0] < 1 for c in mock_sleep.call_args_list))
+        self.assertIn("Failed [HTTP 503] TestCity", ''.join(log.output))
+
+    def test_wttr_read_timeout_is_not_retried(self):
+        """Test that a read timeout surfaces as a Timeout after a single attempt."""
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.path)
+                time.sleep(0.5)
+
+            def log_message(self, *args):
+                pass
+
+        wttr = Wttr(self._serve(Handler) + "/{city},{country}", timeout=(1, 0.1))
+        self.addCleanup(wttr.close)
+
+        with self.assertLogs(level='ERROR') as log:
+            self.assertIsNone(wttr.fetch_data({"city": "TestCity", "country": "TestCountry"}))
+
+        self.assertEqual(len(requests_seen), 1)
+        self.assertIn("Timeout for TestCity", ''.join(log.output))
+
+    def test_wttr_fetch_many(self):
+        """Test that fetch_many pairs each city with its fetched report."""
+        wttr = Wttr("http://wttr.in/{city},{country}?format=j2")
+        cities = [{"city": "CityA", "country": "USA"}, {"city": "CityB", "country": "MEX"}]
+
+        with patch.object(wttr, 'fetch_data', side_effect=lambda city_info: {"name": city_info["city"]}):
+            results = list(wttr.fetch_many(cities))
+        wttr.close()
+
+        self.assertEqual(len(results), 2)
+        for city_info, data in results:
+            self.assertEqual(data["name"], city_info["city"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
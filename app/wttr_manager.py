@@ -1,107 +1,284 @@
 import logging
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
+# orjson parses responses several times faster than the stdlib; optional.
+# Both raise a ValueError subclass on bad input, which fetch_data already handles.
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+log = logging.getLogger("WTTR")
+
+_UTC = ZoneInfo("UTC")
+
+# Returned by fetch_data in place of a report whose observation time hasn't changed
+UNCHANGED = object()
+
+def _first(items):
+    """Return the first element of a JSON list, or None if it's missing or empty."""
+    return items[0] if items else None
+
+@lru_cache(maxsize=None)
+def _get_zone(tz_name):
+    """Return the ZoneInfo for a timezone name, loaded once per name."""
+    return ZoneInfo(tz_name)
+
+# Hours added to the 12-hour clock value (after % 12) for each marker
+_AMPM = {"AM": 0, "PM": 12}
+
+def _parse_wttr_dt(local_obs_str):
+    """Parse wttr.in's "YYYY-MM-DD HH:MM AM" local time into a naive datetime."""
+    # The format is fixed, so split on its separators instead of using strptime,
+    # whose %p goes through the locale on every call
+    date_part, time_part, am_pm = local_obs_str.split(" ")
+    year, month, day = date_part.split("-")
+    hh, mm = time_part.split(":")
+    hour = int(hh)
+    offset = _AMPM.get(am_pm)
+    if offset is None or not 1 <= hour <= 12:
+        raise ValueError(f"unexpected 12-hour time '{time_part} {am_pm}'")
+    return datetime(int(year), int(month), int(day), hour % 12 + offset, int(mm))
+
+# One offset per zone and local day; days with a DST change return None
+@lru_cache(maxsize=64)
+def _day_utc_offset(city_tz, local_date):
+    """Return a zone's UTC offset for a local date, or None if it changes during that day."""
+    zone = _get_zone(city_tz)
+    year, month, day = local_date.year, local_date.month, local_date.day
+    offset = datetime(year, month, day, tzinfo=zone).utcoffset()
+    if datetime(year, month, day, 23, 59, tzinfo=zone).utcoffset() != offset:
+        return None
+    return offset
+
+# Observations only change every ~15 minutes, so most polls hit the cache
+@lru_cache(maxsize=64)
+def _parse_local_obs(local_obs_str, city_tz):
+    """Convert a local observation time string to a naive UTC datetime."""
+    local_dt = _parse_wttr_dt(local_obs_str)
+
+    # Subtract the day's cached offset (naive result, as InfluxDB requires)
+    offset = _day_utc_offset(city_tz, local_dt.date())
+    if offset is not None:
+        return local_dt - offset
+
+    # DST changes on this day, so resolve this exact time through the zone
+    utc_dt = local_dt.replace(tzinfo=_get_zone(city_tz)).astimezone(_UTC)
+    return utc_dt.replace(tzinfo=None)
+
 class Wttr:
 
-    def __init__(self, api_url_template):
+    def __init__(self, api_url_template, timeout=(3.05, 5), max_workers=16, cache_ttl=0, skip_unchanged=False):
         self.api_url_template = api_url_template
+        self.timeout = timeout
+
+        # Pre-split "{city}"/"{country}" templates so building a URL is plain concatenation;
+        # any other template shape falls back to str.format
+        prefix, has_city, rest = api_url_template.partition("{city}")
+        mid, has_country, suffix = rest.partition("{country}")
+        literal = prefix + mid + suffix
+        if has_city and has_country and "{" not in literal and "}" not in literal:
+            self._url_parts = (prefix, mid, suffix)
+        else:
+            self._url_parts = None
+
+        # Successful reports per (city, country), reused for cache_ttl seconds (0 disables)
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+
+        # Last localObsDateTime written per (city, country), used when skip_unchanged is set
+        self.skip_unchanged = skip_unchanged
+        self._last_obs = {}
 
-    def parse_observation_time(self, data, city_info):
+        # City name -> (URL form, lowercase form); names are fixed so each is computed once
+        self._name_cache = {}
+
+        # Worker threads persist across cycles instead of being started on every poll
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # Session lives as long as Wttr so connections to wttr.in are kept alive between polls
+        # Pool holds a socket per worker so every concurrent fetch keeps its connection
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        # Retry connect failures and transient gateway errors quickly instead of waiting for the
+        # next cycle; the final response is still returned so its status gets logged.
+        # Read timeouts aren't retried (read=False re-raises them as Timeout), so a slow city
+        # costs at most one read timeout. Retry-After is ignored: it can ask for hours of
+        # sleep, and only the short backoff fits within a poll cycle.
+        retry = Retry(
+            total=2,
+            connect=2,
+            read=False,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+            respect_retry_after_header=False
+        )
+        adapter = HTTPAdapter(pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        """Stop worker threads and close pooled connections."""
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    @staticmethod
+    def warm_timezones(city_infos):
+        """Load each city's timezone up front so tzdata is read at startup, not mid-poll."""
+        for city_info in city_infos:
+            try:
+                _get_zone(city_info.get("tz", "UTC"))
+            except Exception as e:
+                # Polling continues; parse_observation_time logs this city's timestamps as invalid
+                log.error(f"Unknown timezone for {city_info.get('city')}: {e}")
+
+    @staticmethod
+    def parse_observation_time(data, city_info):
         """Parse wttr.in localObsDateTime from city timezone to UTC datetime."""
         try:
             current_condition = data.get("current_condition", [{}])[0]
             local_obs_str = current_condition.get("localObsDateTime")
             city_tz = city_info.get("tz", "UTC")
 
-            # Parse local datetime string
-            local_dt = datetime.strptime(local_obs_str, "%Y-%m-%d %I:%M %p")
-
-            # Attach local timezone
-            local_dt = local_dt.replace(tzinfo=ZoneInfo(city_tz))
-
-            # Convert to UTC
-            utc_dt = local_dt.astimezone(ZoneInfo("UTC"))
-
-            # Strip tzinfo (InfluxDB requires naive datetime)
-            utc_dt = utc_dt.replace(tzinfo=None)
-
-            return utc_dt
+            return _parse_local_obs(local_obs_str, city_tz)
 
         except Exception as e:
             city = city_info.get("city")
-            logging.error(f"WTTR     : Failed to parse timestamp for {city}: {e}")
+            log.error(f"Failed to parse timestamp for {city}: {e}")
             return None
 
+    def _check_unchanged(self, cache_key, data):
+        """Return UNCHANGED if data repeats the last observation written for this city."""
+        if not self.skip_unchanged:
+            return data
+        local_obs_str = data["current_condition"][0].get("localObsDateTime")
+        if local_obs_str is not None and self._last_obs.get(cache_key) == local_obs_str:
+            return UNCHANGED
+        return data
+
+    def mark_written(self, city_info, data):
+        """Record a report's observation time once its point has been written."""
+        if self.skip_unchanged:
+            cache_key = (city_info.get("city"), city_info.get("country"))
+            self._last_obs[cache_key] = data["current_condition"][0].get("localObsDateTime")
+
+    def fetch_many(self, cities):
+        """
+        Fetch weather reports for several cities concurrently.
+        Yields (city_info, data) pairs in the order fetches complete.
+        """
+        futures = {self.executor.submit(self.fetch_data, city_info): city_info for city_info in cities}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
     def fetch_data(self, location_info):
-        """Fetch weather report for a city."""
+        """
+        Fetch weather report for a city.
+        With skip_unchanged set, returns UNCHANGED instead of a report that repeats the last written observation.
+        """
         city = location_info.get("city")
         country = location_info.get("country")
 
-        # Replace spaces with + for wttr.in (works better than %20 encoding)
-        city_formatted = city.replace(' ', '+')
-        api_url = self.api_url_template.format(city=city_formatted, country=country)
+        cache_key = (city, country)
+        if self.cache_ttl:
+            cached = self._cache.get(cache_key)
+            if cached and time.monotonic() - cached[0] < self.cache_ttl:
+                return self._check_unchanged(cache_key, cached[1])
 
-        start = time.time()
+        names = self._name_cache.get(city)
+        if names is None:
+            # Replace spaces with + for wttr.in (works better than %20 encoding)
+            names = self._name_cache[city] = (city.replace(' ', '+'), city.lower())
+        city_formatted, city_lower = names
+        if self._url_parts:
+            prefix, mid, suffix = self._url_parts
+            api_url = prefix + city_formatted + mid + country + suffix
+        else:
+            api_url = self.api_url_template.format(city=city_formatted, country=country)
+
+        start = time.monotonic()
         
         try:
-            response = requests.get(api_url, timeout=10)
-            duration = time.time() - start
+            response = self.session.get(api_url, timeout=location_info.get("timeout", self.timeout))
+            duration = time.monotonic() - start
 
             if response.status_code == 200:
                 try:
-                    data = response.json()
+                    data = _json_loads(response.content)
                     
                     # Check if it's actually an error disguised as 200 OK
                     # wttr.in returns "Unknown location" when at capacity
-                    nearest_area = data.get("nearest_area", [{}])[0]
-                    if not nearest_area or nearest_area.get("areaName", [{}])[0].get("value") == "":
-                        logging.error(f"WTTR     : Service at capacity for {city} (returned empty location) - {api_url}")
+                    nearest_area = _first(data.get("nearest_area"))
+                    area_name = _first(nearest_area.get("areaName")) if nearest_area else None
+                    if not nearest_area or (area_name and area_name.get("value") == ""):
+                        log.error("Service at capacity for %s (returned empty location) - %s", city, api_url)
                         return None
                     
                     # Also check for the "Unknown location" message
                     current_condition = data.get("current_condition", [])
                     if not current_condition:
-                        logging.error(f"WTTR     : Service at capacity for {city} (no weather data) - {api_url}")
+                        log.error("Service at capacity for %s (no weather data) - %s", city, api_url)
                         return None
                     
-                    logging.debug(f"WTTR     : Fetched {city} in {duration:.2f}s")
-                    return data
+                    # Keep only the sections points are built from so cached reports stay small
+                    data = {"current_condition": current_condition, "nearest_area": data["nearest_area"]}
+
+                    log.debug("Fetched %s in %.2fs", city, duration)
+                    if self.cache_ttl:
+                        self._cache[cache_key] = (time.monotonic(), data)
+                    return self._check_unchanged(cache_key, data)
                     
                 except (KeyError, IndexError, ValueError) as e:
-                    logging.error(f"WTTR     : Invalid response for {city} - {str(e)}")
+                    log.error(f"Invalid response for {city} - {str(e)}")
                     return None
             
             elif response.status_code == 404:
                 # wttr.in bug: 404s sometimes return weather data for wrong city
                 # https://github.com/chubin/wttr.in/issues/500
-                if len(response.content) > 1000:
+                # Prefer Content-Length so short 404 bodies don't need to be read
+                # (only when uncompressed, since it's the size on the wire)
+                content_length = None if response.headers.get("Content-Encoding") else response.headers.get("Content-Length")
+                try:
+                    body_size = int(content_length)
+                except (TypeError, ValueError):
+                    # Missing or malformed header; measure the body instead
+                    body_size = len(response.content)
+                if body_size > 1000:
                     try:
-                        data = response.json()
-                        returned_city = data.get("nearest_area", [{}])[0].get("areaName", [{}])[0].get("value", "")
-                        if returned_city and returned_city.lower() != city.lower():
-                            logging.warning(f"WTTR     : 404 for '{city}' - API returned '{returned_city}' instead - {api_url}")
+                        data = _json_loads(response.content)
+                        nearest_area = _first(data.get("nearest_area"))
+                        area_name = _first(nearest_area.get("areaName")) if nearest_area else None
+                        returned_city = area_name.get("value", "") if area_name else ""
+                        if returned_city and returned_city.lower() != city_lower:
+                            log.warning("404 for '%s' - API returned '%s' instead - %s", city, returned_city, api_url)
                         else:
-                            logging.error(f"WTTR     : Failed [HTTP 404] {city} - {api_url}")
+                            log.error("Failed [HTTP 404] %s - %s", city, api_url)
                     except (KeyError, IndexError, ValueError):
-                        logging.error(f"WTTR     : Failed [HTTP 404] {city} - {api_url}")
+                        log.error("Failed [HTTP 404] %s - %s", city, api_url)
                 else:
-                    logging.error(f"WTTR     : Failed [HTTP 404] {city} - {api_url}")
+                    log.error("Failed [HTTP 404] %s - %s", city, api_url)
                 return None
             
             else:
-                logging.error(f"WTTR     : Failed [HTTP {response.status_code}] {city} - {api_url}")
+                log.error("Failed [HTTP %d] %s - %s", response.status_code, city, api_url)
                 return None
 
         except requests.exceptions.Timeout:
-            duration = time.time() - start
-            logging.error(f"WTTR     : Timeout for {city} after {duration:.1f}s - {api_url}")
+            duration = time.monotonic() - start
+            log.error(f"Timeout for {city} after {duration:.1f}s - {api_url}")
             return None
         except requests.exceptions.ConnectionError as e:
-            logging.error(f"WTTR     : Connection failed for {city} - {str(e)[:80]}")
+            log.error(f"Connection failed for {city} - {str(e)[:80]}")
             return None
         except requests.exceptions.RequestException as e:
-            logging.error(f"WTTR     : Request failed for {city} - {str(e)[:80]}")
+            log.error(f"Request failed for {city} - {str(e)[:80]}")
             return None
\ No newline at end of file